@@ -0,0 +1,72 @@
+"""Test identifying the files under a set of paths that could contain vaulted data"""
+# pylint: disable=protected-access
+import os
+
+import pytest
+
+import vault2vault
+
+
+def test_compile_excludes():
+    """Test that the exclude patterns are combined into a single regex"""
+    assert vault2vault._compile_excludes([]) is None
+
+    exclude = vault2vault._compile_excludes([".git", "*.bak"])
+    assert exclude.match(".git")
+    assert exclude.match("vars.yml.bak")
+    assert not exclude.match(".github")
+    assert not exclude.match("vars.yml")
+
+
+def test_exclude(tmp_path):
+    """Test that excluded files and directories are skipped"""
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".git" / "config.yml").write_text("", encoding="utf-8")
+    (tmp_path / "vars.yml").write_text("", encoding="utf-8")
+    (tmp_path / "vars.yml.bak.yml").write_text("", encoding="utf-8")
+
+    assert vault2vault._expand_paths(
+        [tmp_path], exclude=vault2vault._compile_excludes([".git", "*.bak.yml"])
+    ) == [(tmp_path / "vars.yml").resolve()]
+
+
+def test_vault_header(tmp_path):
+    """Test that files without a YAML extension are only included when vault encrypted"""
+    (tmp_path / "secrets").write_bytes(b"$ANSIBLE_VAULT;1.1;AES256\n0123\n")
+    (tmp_path / "README").write_bytes(b"Nothing to see here\n")
+    (tmp_path / "VARS.YAML").write_bytes(b"key: value\n")
+
+    assert sorted(vault2vault._expand_paths([tmp_path])) == sorted(
+        [(tmp_path / "secrets").resolve(), (tmp_path / "VARS.YAML").resolve()]
+    )
+
+
+def test_broken_symlink(tmp_path):
+    """Test that broken symlinks are skipped, even with a YAML extension"""
+    (tmp_path / "broken.yml").symlink_to(tmp_path / "missing.yml")
+    (tmp_path / "broken").symlink_to(tmp_path / "missing")
+
+    assert not vault2vault._expand_paths([tmp_path])
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="FIFOs are not supported")
+def test_fifo(tmp_path):
+    """Test that FIFOs are skipped without trying to read from them"""
+    os.mkfifo(tmp_path / "pipe")
+    os.mkfifo(tmp_path / "pipe.yml")
+
+    assert not vault2vault._expand_paths([tmp_path])
+
+
+def test_deduplicate(tmp_path):
+    """Test that a file found through more than one path is only included once"""
+    (tmp_path / "group_vars").mkdir()
+    (tmp_path / "group_vars" / "vars.yml").write_text("", encoding="utf-8")
+    (tmp_path / "link.yml").symlink_to(tmp_path / "group_vars" / "vars.yml")
+    (tmp_path / "host_vars").symlink_to(
+        tmp_path / "group_vars", target_is_directory=True
+    )
+
+    assert vault2vault._expand_paths(
+        [tmp_path, tmp_path / "group_vars" / "vars.yml", tmp_path / "link.yml"]
+    ) == [(tmp_path / "group_vars" / "vars.yml").resolve()]
@@ -0,0 +1,230 @@
+"""Test rekeying the vaulted content of individual files"""
+from pathlib import Path
+from typing import Any
+from typing import List
+from typing import Optional
+
+import pytest
+import yaml
+from ansible.parsing.vault import VaultLib
+from ansible.parsing.vault import VaultSecret
+
+import vault2vault
+
+
+OLD_VAULT = VaultLib([("default", VaultSecret(b"old-password"))])
+NEW_VAULT = VaultLib([("default", VaultSecret(b"new-password"))])
+OTHER_VAULT = VaultLib([("default", VaultSecret(b"other-password"))])
+
+
+def _vaulted(vault: VaultLib, value: str, padding: int) -> str:
+    """Encrypt a value and format it as an indented vault block"""
+    return "\n".join(
+        f"{' ' * padding}{line}"
+        for line in vault.encrypt(value.encode("utf-8")).decode("utf-8").splitlines()
+    )
+
+
+def _load_decrypted(path: Path, vault: VaultLib) -> Any:
+    """Load a YAML file, decrypting any vaulted variables with the provided vault"""
+
+    class _Loader(yaml.SafeLoader):  # pylint: disable=too-many-ancestors
+        pass
+
+    _Loader.add_constructor(
+        "!vault", lambda loader, node: vault.decrypt(node.value).decode("utf-8")
+    )
+    return yaml.load(path.read_text(encoding="utf-8"), Loader=_Loader)  # nosec
+
+
+@pytest.fixture(name="yaml_loads")
+def _yaml_loads(monkeypatch) -> List[bytes]:
+    """Record every time the YAML parser is used to process a file"""
+    calls: List[bytes] = []
+    original = vault2vault.yaml.load
+
+    def _load(stream, *args, **kwargs):
+        calls.append(stream)
+        return original(stream, *args, **kwargs)
+
+    monkeypatch.setattr(vault2vault.yaml, "load", _load)
+    return calls
+
+
+def _process(path: Path, ignore: bool = False) -> Optional[List[int]]:
+    return vault2vault._process_file(  # pylint: disable=protected-access
+        path, OLD_VAULT, NEW_VAULT, interactive=False, backup=False, ignore=ignore
+    )
+
+
+def test_rekey_block_scalars(tmp_path, yaml_loads):
+    """Test that vaulted block scalars are rekeyed without parsing the file"""
+    path = tmp_path / "vars.yml"
+    path.write_text(
+        f"""---
+first: !vault |
+{_vaulted(OLD_VAULT, "one", 2)}
+nested:
+  items:
+    - plain
+    - !vault |
+{_vaulted(OLD_VAULT, "two", 6)}
+last: 3
+""",
+        encoding="utf-8",
+    )
+
+    assert _process(path) is None
+    assert not yaml_loads
+    assert _load_decrypted(path, NEW_VAULT) == {
+        "first": "one",
+        "nested": {"items": ["plain", "two"]},
+        "last": 3,
+    }
+
+
+def test_rekey_crlf_block_scalars(tmp_path, yaml_loads):
+    """Test that rekeyed block scalars keep the CRLF line endings of the file"""
+    path = tmp_path / "vars.yml"
+    content = f"""a: !vault |
+{_vaulted(OLD_VAULT, "one", 2)}
+b: 2
+"""
+    path.write_bytes(content.replace("\n", "\r\n").encode("utf-8"))
+
+    assert _process(path) is None
+    assert not yaml_loads
+
+    updated = path.read_bytes()
+    assert updated.count(b"\n") == updated.count(b"\r\n")
+    assert updated.endswith(b"\r\nb: 2\r\n")
+    assert _load_decrypted(path, NEW_VAULT) == {"a": "one", "b": 2}
+
+
+def test_vault_text_in_block_scalar(tmp_path, yaml_loads):
+    """Test that vault-like text inside an ordinary block scalar is left alone"""
+    example = f"""password: !vault |
+{_vaulted(OTHER_VAULT, "example", 4)}"""
+    description = "\n".join(f"  {line}" for line in example.splitlines())
+    path = tmp_path / "vars.yml"
+    path.write_text(
+        f"""---
+description: |
+{description}
+secret: !vault |
+{_vaulted(OLD_VAULT, "real", 2)}
+""",
+        encoding="utf-8",
+    )
+
+    assert _process(path) is None
+    assert len(yaml_loads) == 1
+
+    assert description in path.read_text(encoding="utf-8")
+    assert _load_decrypted(path, NEW_VAULT) == {
+        "description": f"{example}\n",
+        "secret": "real",
+    }
+
+
+def test_fallback_unrecognized_vault_tag(tmp_path, yaml_loads):
+    """Test that a vault tag the raw scan doesn't recognize falls back to parsing"""
+    path = tmp_path / "vars.yml"
+    path.write_text(
+        f"""---
+# These are all !vault encrypted
+secret: !vault |
+{_vaulted(OLD_VAULT, "value", 2)}
+""",
+        encoding="utf-8",
+    )
+
+    assert _process(path) is None
+    assert len(yaml_loads) == 1
+    assert _load_decrypted(path, NEW_VAULT) == {"secret": "value"}
+
+
+def test_fallback_ordered_mappings(tmp_path, yaml_loads):
+    """Test that vaulted values in ordered mappings are rekeyed when parsing the file"""
+    path = tmp_path / "vars.yml"
+    path.write_text(
+        f"""---
+# These are all !vault encrypted
+omap: !!omap
+  - first: !vault |
+{_vaulted(OLD_VAULT, "one", 6)}
+  - second: plain
+pairs: !!pairs
+  - key: !vault |
+{_vaulted(OLD_VAULT, "two", 6)}
+  - key: !vault |
+{_vaulted(OLD_VAULT, "three", 6)}
+""",
+        encoding="utf-8",
+    )
+
+    assert _process(path) is None
+    assert len(yaml_loads) == 1
+    assert _load_decrypted(path, NEW_VAULT) == {
+        "omap": [("first", "one"), ("second", "plain")],
+        "pairs": [("key", "two"), ("key", "three")],
+    }
+
+
+def test_fallback_aliases(tmp_path, yaml_loads):
+    """Test that aliases and merge keys referring to vaulted values are skipped when parsing"""
+    path = tmp_path / "vars.yml"
+    path.write_text(
+        f"""---
+# These are all !vault encrypted
+base: &base
+  secret: &secret !vault |
+{_vaulted(OLD_VAULT, "one", 4)}
+alias: *secret
+merged:
+  <<: *base
+  other: !vault |
+{_vaulted(OLD_VAULT, "two", 4)}
+""",
+        encoding="utf-8",
+    )
+
+    assert _process(path) is None
+    assert len(yaml_loads) == 1
+    assert _load_decrypted(path, NEW_VAULT) == {
+        "base": {"secret": "one"},
+        "alias": "one",
+        "merged": {"secret": "one", "other": "two"},
+    }
+
+
+def test_skip_file_without_vault_tags(tmp_path, yaml_loads):
+    """Test that YAML files without any vault tags are not parsed or modified"""
+    path = tmp_path / "vars.yml"
+    path.write_text("---\nkey: value\n", encoding="utf-8")
+
+    assert _process(path) is not None
+    assert not yaml_loads
+    assert path.read_text(encoding="utf-8") == "---\nkey: value\n"
+
+
+def test_block_scalar_names(tmp_path, caplog):
+    """Test that the raw scan identifies vaulted variables by key and line number"""
+    path = tmp_path / "vars.yml"
+    path.write_text(
+        f"""---
+nested:
+  inner: &anchor !vault |
+{_vaulted(OLD_VAULT, "one", 4)}
+  items:
+    - !vault |
+{_vaulted(OLD_VAULT, "two", 6)}
+""",
+        encoding="utf-8",
+    )
+
+    with caplog.at_level("INFO", logger=vault2vault.__name__):
+        _process(path)
+
+    assert f"Identified vaulted content in {path} at inner (line 3)" in caplog.messages
+    assert f"Identified vaulted content in {path} at line 11" in caplog.messages
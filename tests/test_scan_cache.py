@@ -0,0 +1,79 @@
+"""Test the cache of files that are known to contain no vaulted data"""
+# pylint: disable=protected-access
+import os
+
+from ansible.parsing.vault import VaultLib
+from ansible.parsing.vault import VaultSecret
+
+import vault2vault
+
+
+VAULT = VaultLib([("default", VaultSecret(b"password"))])
+
+
+def test_filter_scanned(tmp_path):
+    """Test that only unchanged files recorded in the cache are skipped"""
+    unchanged = tmp_path / "unchanged.yml"
+    unchanged.write_text("key: value\n", encoding="utf-8")
+    modified = tmp_path / "modified.yml"
+    modified.write_text("key: value\n", encoding="utf-8")
+    uncached = tmp_path / "uncached.yml"
+    uncached.write_text("key: value\n", encoding="utf-8")
+    deleted = tmp_path / "deleted.yml"
+
+    cache = {
+        str(unchanged): vault2vault._get_scan_key(unchanged),
+        str(modified): vault2vault._get_scan_key(modified),
+        str(deleted): [0, 0],
+    }
+    modified.write_text("key: other value\n", encoding="utf-8")
+
+    assert vault2vault._filter_scanned(
+        [unchanged, modified, uncached, deleted], cache
+    ) == [modified, uncached]
+    assert str(deleted) not in cache
+
+
+def test_scan_key_taken_before_read(tmp_path):
+    """Test that a file modified after it was processed is scanned again"""
+    path = tmp_path / "vars.yml"
+    path.write_text("key: value\n", encoding="utf-8")
+    # Make sure the modification below changes the file stats even on filesystems with
+    # coarse timestamps
+    os.utime(path, ns=(0, 0))
+
+    scan_key = vault2vault._process_file(
+        path, VAULT, VAULT, interactive=False, backup=False, ignore=False
+    )
+    assert scan_key == [0, path.stat().st_size]
+
+    path.write_text("key: !vault |\n  $ANSIBLE_VAULT;1.1;AES256\n", encoding="utf-8")
+
+    cache: dict = {}
+    vault2vault._update_scan_cache(cache, [path], [scan_key])
+    assert vault2vault._filter_scanned([path], cache) == [path]
+
+
+def test_update_scan_cache(tmp_path):
+    """Test that vaulted and deleted files are removed from the cache"""
+    clean = tmp_path / "clean.yml"
+    clean.write_text("key: value\n", encoding="utf-8")
+    vaulted = tmp_path / "vaulted.yml"
+    vaulted.write_text("key: value\n", encoding="utf-8")
+
+    cache = {str(vaulted): [1, 2], str(tmp_path / "deleted.yml"): [1, 2]}
+    vault2vault._update_scan_cache(cache, [clean, vaulted], [[3, 4], None])
+
+    assert cache == {str(clean): [3, 4]}
+
+
+def test_scan_cache_round_trip(tmp_path):
+    """Test that the cache can be saved and loaded, and that a bad cache is ignored"""
+    cache_path = tmp_path / "cache" / "scanned.json"
+    assert not vault2vault._load_scan_cache(cache_path)
+
+    vault2vault._save_scan_cache(cache_path, {"/some/file.yml": [1, 2]})
+    assert vault2vault._load_scan_cache(cache_path) == {"/some/file.yml": [1, 2]}
+
+    cache_path.write_text("not json", encoding="utf-8")
+    assert not vault2vault._load_scan_cache(cache_path)
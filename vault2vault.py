@@ -1,20 +1,37 @@
 """CLI tool for recursively rekeying ansible-vault encrypted secrets"""
 import argparse
+import concurrent.futures
+import fnmatch
+import functools
 import getpass
+import json
 import logging
+import os
 import re
 import shutil
 import sys
+from collections import deque
 from pathlib import Path
 from typing import Any
+from typing import Callable
+from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Pattern
+from typing import Sequence
+from typing import Tuple
 
-import ruamel.yaml
+import yaml
+
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader  # type: ignore
 
 try:
     import ansible.constants
+    from ansible.parsing.vault import VaultAES256
     from ansible.parsing.vault import VaultSecret
     from ansible.parsing.vault import VaultLib
     from ansible.parsing.vault import AnsibleVaultError
@@ -25,6 +42,11 @@ except ImportError:
     )
     sys.exit(1)
 
+try:
+    from ansible.parsing.vault import HAS_CRYPTOGRAPHY as _HAS_CRYPTOGRAPHY
+except ImportError:
+    _HAS_CRYPTOGRAPHY = False
+
 
 __title__ = "vault2vault"
 __summary__ = "Recursively rekey ansible-vault encrypted files and in-line variables"
@@ -36,14 +58,96 @@ __authors__ = ["Ethan Paul <24588726+enpaul@users.noreply.github.com>"]
 
 YAML_FILE_EXTENSIONS = (".yml", ".yaml")
 
-yaml = ruamel.yaml.YAML(typ="rt")
+DEFAULT_EXCLUDES = (".git",)
+
+_VAULT_HEADER = b"$ANSIBLE_VAULT"
+
+_VAULT_HEADER_TEXT = _VAULT_HEADER.decode("ascii")
+
+_YES_ANSWERS = frozenset({"yes", "y"})
+
+_NO_ANSWERS = frozenset({"no", "n"})
+
+# Vault objects used by worker processes, populated by ``_init_worker``
+_WORKER_VAULTS: Dict[str, VaultLib] = {}
 
-ruamel.yaml.add_constructor(
-    "!vault",
-    lambda loader, node: node.value,
-    constructor=ruamel.yaml.SafeConstructor,
+_INDENT_RE = re.compile(rb"^(?=.)", re.MULTILINE)
+
+# Matches the common form of a vault encrypted YAML variable, a literal block scalar
+# tagged with ``!vault``. The ``prefix`` group is the text on the line before the tag,
+# the ``block`` group is the indented vault content, excluding the final newline, and
+# the ``indent`` group is the indentation of that content
+_VAULT_BLOCK_RE = re.compile(
+    rb"^(?P<prefix>[^\n]*?)!vault[ \t]*\|[-+]?[ \t]*\r?\n"
+    rb"(?P<block>(?P<indent>[ \t]+)\$ANSIBLE_VAULT[^\n]*"
+    rb"(?:\n(?P=indent)[0-9a-fA-F]+[ \t\r]*(?=\n|\Z))*)",
+    re.MULTILINE,
+)
+
+# Matches the text before a tag on a line that is a mapping key, optionally nested in
+# one or more sequence items and optionally with an anchor. The ``key`` group is the key
+_KEY_PREFIX_RE = re.compile(
+    rb"^[ \t]*(?:-[ \t]+)*"
+    rb"(?P<key>\"[^\"\n]*\"|'[^'\n]*'|[^\s#\"'][^#\n]*?)[ \t]*:[ \t]+"
+    rb"(?:&\S+[ \t]+)?$"
 )
 
+# Matches any line ending in a block scalar header (``|`` or ``>`` with optional chomping
+# and indentation indicators, and an optional trailing comment)
+_BLOCK_SCALAR_RE = re.compile(
+    rb"(?:^|[ \t])[|>][-+1-9]{0,2}[ \t]*(?:#[^\n]*)?\r?$", re.MULTILINE
+)
+
+
+class _VaultTag:  # pylint: disable=too-few-public-methods
+    """Wrapper for the raw value of a ``!vault`` tagged scalar parsed from a YAML file
+
+    :param value: Raw (encrypted) text content of the tagged scalar
+    """
+
+    def __init__(self, value: str):
+        self.value = value
+
+
+# YAML loader used to scan files for vault encrypted variables. The parsed data is only
+# ever used to locate vaulted content; the actual file updates are done against the raw
+# text. A subclass is used so that the custom constructors registered below don't leak
+# into the global PyYAML loaders. It is created dynamically rather than with a class
+# statement so that mypyc doesn't compile it as a native subclass of the libyaml
+# extension type, which crashes when it is instantiated
+_VaultLoader: Any = type("_VaultLoader", (_SafeLoader,), {})
+
+
+def _construct_unknown_tag(  # pylint: disable=unused-argument
+    loader: Any, suffix: str, node: yaml.Node
+) -> Any:
+    """Construct any YAML tag that isn't explicitly supported as its untagged equivalent
+
+    Ansible supports several custom tags (``!unsafe`` for example) which the safe loader
+    would otherwise refuse to parse.
+    """
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node)
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node)
+    return loader.construct_scalar(node)
+
+
+_VaultLoader.add_constructor("!vault", lambda loader, node: _VaultTag(node.value))
+_VaultLoader.add_multi_constructor("!", _construct_unknown_tag)
+
+# Dispatch table of the container types produced by ``_VaultLoader`` to a function that
+# iterates over the (key, child) pairs of the container. The loader builds every container
+# as one of these exact types, so looking up ``type(node)`` is safe and skips the MRO walk
+# that chained ``isinstance`` checks would need for every node in the document. Ordered
+# mappings (``!!omap`` and ``!!pairs``) are built as a list of (key, value) tuples, which
+# are treated as a mapping with a single item
+_YAML_CHILDREN: Dict[type, Callable[[Any], Iterable[Tuple[Any, Any]]]] = {
+    dict: dict.items,
+    list: enumerate,
+    tuple: lambda pair: (pair,),
+}
+
 
 def rekey(
     old: VaultLib,
@@ -63,16 +167,83 @@ def rekey(
     return new.encrypt(old.decrypt(content))
 
 
+@functools.lru_cache(maxsize=1024)
+def _rekey_variable_cached(old: VaultLib, new: VaultLib, content: bytes) -> bytes:
+    """Rekey a vaulted variable, returning the cached result if it was already rekeyed
+
+    Rekeying the same variable more than once returns the same re-encrypted content rather
+    than encrypting it again, so duplicated copies of a vaulted variable stay identical to
+    each other after rekeying and only pay the cost of decryption and encryption once. The
+    cache is keyed on the identity of the ``VaultLib`` objects, so the same objects need to
+    be reused for every call to benefit from it. Whole vault encrypted files are never
+    duplicated, so they're rekeyed with :func:`rekey` directly instead of filling the cache.
+
+    :param old: ``VaultLib`` object populated with the vault password the content is
+                currently encrypted with
+    :param new: ``VaultLib`` object populated with the vault password the content will
+                be re-encrypted with
+    :param content: Content of the vaulted variable to rekey
+    :returns: The rekeyed content of the vaulted variable
+    """
+    return rekey(old, new, content)
+
+
+def _indent(content: bytes, padding: int) -> bytes:
+    """Indent every non-empty line of some content
+
+    :param content: Text content to indent
+    :param padding: Number of spaces to add to the start of each non-empty line
+    :returns: The indented content with any leading or trailing newlines stripped
+    """
+    return _INDENT_RE.sub(b" " * padding, content.strip(b"\n"))
+
+
+def _get_prefix_key(prefix: bytes) -> Optional[str]:
+    """Determine the mapping key from the text on a line before a vault tag
+
+    :param prefix: Text on the line before the vault tag
+    :returns: The mapping key, or ``None`` if the prefix doesn't include one (for example
+              when the vaulted content is a sequence item)
+    """
+    match = _KEY_PREFIX_RE.match(prefix)
+    if not match:
+        return None
+    key = match.group("key").decode("utf-8", errors="replace")
+    if key[0] in "\"'":
+        key = key[1:-1]
+    return key
+
+
+def _get_line_padding(content: bytes, line: bytes) -> Optional[int]:
+    """Determine the leading whitespace of the first line in some content matching a string
+
+    :param content: Text content to search through
+    :param line: Text of the line to search for, excluding any leading whitespace
+    :returns: The number of leading whitespace characters on the first line of ``content``
+              which consists of ``line`` following only whitespace, or ``None`` if no such
+              line exists
+    """
+    index = content.find(line)
+    while index >= 0:
+        start = content.rfind(b"\n", 0, index) + 1
+        end = index + len(line)
+        if not content[start:index].strip() and content.startswith(b"\n", end):
+            return index - start
+        index = content.find(line, end)
+    return None
+
+
 # This whole function needs to be rebuilt from the ground up so I don't
 # feel bad about disabling this warning
-def _process_file(  # pylint: disable=too-many-statements
+def _process_file(  # pylint: disable=too-many-statements,too-many-locals
     path: Path,
     old: VaultLib,
     new: VaultLib,
     interactive: bool,
     backup: bool,
     ignore: bool,
-) -> None:
+    threads: int = 1,
+) -> Optional[List[int]]:
     """Determine whether a filepath includes vaulted data and if so, rekey it
 
     :param path: Path to the file to check
@@ -84,133 +255,223 @@ def _process_file(  # pylint: disable=too-many-statements
                    in-place changes
     :param ignore: Whether to ignore any errors that come from failing to decrypt
                    any vaulted data
+    :param threads: Maximum number of threads to use for rekeying vaulted variables in the
+                    file concurrently
+    :returns: If the file contains no vaulted data then its modification time (in
+              nanoseconds) and size from just before it was read, otherwise ``None``
     """
 
     logger = logging.getLogger(__name__)
 
     logger.debug(f"Processing file {path}")
 
-    def _process_yaml_data(  # pylint: disable=too-many-locals
-        content: bytes, data: Any, ignore: bool, name: str = ""
-    ):
-        if isinstance(data, dict):
-            for key, value in data.items():
-                content = _process_yaml_data(
-                    content, value, ignore, name=f"{name}.{key}"
+    # YAML aliases are constructed as the same python object as the anchor they refer
+    # to, so tracking the object IDs of the vaulted values that have already been seen
+    # lets us identify when a vaulted value is actually an alias to an existing value
+    seen = set()
+
+    def _confirm_variable(name: str) -> bool:
+        logger.info(f"Identified vaulted content in {path} at {name}")
+        confirm = (
+            _confirm(f"Rekey vault encrypted variable at {name} in file {path}?")
+            if interactive
+            else True
+        )
+
+        if not confirm:
+            logger.debug(
+                f"User skipped vault encrypted content in {path} at {name} via interactive mode"
+            )
+        return confirm
+
+    def _rekey_variable(old_data: bytes, name: str) -> Optional[bytes]:
+        try:
+            return _rekey_variable_cached(old, new, old_data)
+        except AnsibleVaultError as err:
+            msg = f"Failed to decrypt vault encrypted data in {path} at {name} with provided vault secret"
+            if ignore:
+                logger.warning(msg)
+                return None
+            raise RuntimeError(msg) from err
+
+    def _process_vault_blocks(content: bytes) -> Optional[bytes]:
+        # Scanning the raw content for vaulted blocks directly is much faster than parsing
+        # the YAML, but it only recognizes the common ``!vault |`` block scalar form. If it
+        # doesn't find a block for every vault tag in the file then we can't be sure that
+        # everything will be rekeyed, so the caller needs to fall back to parsing the YAML
+        matches = list(_VAULT_BLOCK_RE.finditer(content))
+        if len(matches) != content.count(b"!vault"):
+            return None
+        # The raw scan also can't tell a vaulted block apart from the same text embedded in
+        # some other block scalar (an example in a description, for instance), so if there
+        # are any block scalars in the file other than the vaulted ones then the file needs
+        # to be parsed to know which is which
+        if len(_BLOCK_SCALAR_RE.findall(content)) != len(matches):
+            return None
+
+        # Any interactive prompts need to happen one at a time, so all the blocks to rekey
+        # are identified up front before any of the actual rekeying is done
+        targets = []
+        lineno = 1
+        for index, match in enumerate(matches):
+            lineno += content.count(
+                b"\n", matches[index - 1].start() if index else 0, match.start()
+            )
+            # The parsed key path isn't available without parsing the YAML, but the key of the
+            # variable itself is usually on the same line as the vault tag
+            key = _get_prefix_key(match.group("prefix"))
+            name = f"{key} (line {lineno})" if key else f"line {lineno}"
+            if _confirm_variable(name):
+                # Strip the indentation from the block to get the same value that the YAML
+                # parser would have produced for it
+                old_data = (
+                    b"\n".join(
+                        line.strip() for line in match.group("block").split(b"\n")
+                    )
+                    + b"\n"
                 )
-        elif isinstance(data, list):
-            for index, item in enumerate(data):
-                content = _process_yaml_data(
-                    content, item, ignore, name=f"{name}.{index}"
+                targets.append((match, old_data, name))
+
+        # Key derivation is the bulk of the work for each vaulted block, and the underlying
+        # crypto backend can release the GIL while doing it, so multiple blocks can be
+        # rekeyed at once using threads
+        if threads > 1 and len(targets) > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(threads, len(targets))
+            ) as executor:
+                results = list(
+                    executor.map(
+                        lambda target: _rekey_variable(target[1], target[2]), targets
+                    )
                 )
-        elif isinstance(data, ruamel.yaml.comments.TaggedScalar) and old.is_encrypted(
-            data.value
-        ):
-            logger.info(f"Identified vaulted content in {path} at {name}")
-            confirm = (
-                _confirm(f"Rekey vault encrypted variable {name} in file {path}?")
-                if interactive
-                else True
+        else:
+            results = [_rekey_variable(old_data, name) for _, old_data, name in targets]
+
+        chunks = []
+        position = 0
+        for (match, _, _), new_data in zip(targets, results):
+            if new_data is None:
+                continue
+            # The rekeyed content only uses LF line endings, so they need to be converted to
+            # match the line endings used by the original block. The block ends before the
+            # final newline, so a CRLF block also needs to keep its trailing carriage return
+            newline = b"\r\n" if match.group("block").endswith(b"\r") else b"\n"
+            chunks.append(content[position : match.start("block")])
+            chunks.append(
+                _indent(new_data, len(match.group("indent"))).replace(b"\n", newline)
+                + newline[:-1]
             )
-
-            if not confirm:
+            position = match.end("block")
+        chunks.append(content[position:])
+        return b"".join(chunks)
+
+    def _rekey_one(content: bytes, data: _VaultTag, name: str) -> bytes:
+        is_alias = id(data) in seen
+        seen.add(id(data))
+
+        # Vaulted content is pure ASCII, so all of the processing below can be done directly
+        # on the raw bytes of the file without ever needing to decode it
+        old_data = data.value.encode("utf-8")
+
+        if not _confirm_variable(name):
+            return content
+
+        new_data = _rekey_variable(old_data, name)
+        if new_data is None:
+            return content
+
+        # Ok so this next section is probably the worst possible way to do this, but I did
+        # it this way to solve a very specific problem that would absolutely prevent people
+        # from using this tool: round trip YAML format preservation. Namely, that it's impossible.
+        # Ruamel gets the closest to achieving this: it can do round trip format preservation
+        # when the starting state is in _some_ known state (this is better than competitors which
+        # require the starting state to be in a _specific_ known state). But given how many
+        # ways there are to write YAML- and by extension, how many opinions there are on the
+        # "correct" way to write YAML- it is not possible to configure ruamel to account for all of
+        # them, even if everyones YAML style was compatible with ruamel's roundtrip formatting (note:
+        # they aren't). So there's the problem: to be useful, this tool would need to reformat every
+        # YAML file it touched, which means nobody would use it.
+        #
+        # To avoid the YAML formatting problem, we need a way to replace the target content
+        # in the raw text of the file without dumping the parsed YAML. We want to preserve
+        # indendation, remove any extra newlines that would be left over, add any necessary
+        # newlines without clobbering the following lines, and ideally avoid reimplementing
+        # a YAML formatter. The answer to this problem- as the answer to so many stupid problems
+        # seems to be- is a regex. If this is too janky for you (I know it is for me) go support
+        # the estraven project I'm trying to get off the ground: https://github.com/enpaul/estraven
+        #
+        # Ok, thanks for sticking with me as I was poetic about this. The solution below...
+        # is awful, I can admit that. But it does work, so I'll leave it up to
+        # your judgement as to whether it's worthwhile or not. Here's how it works:
+        #
+        # 1. First we take the first line of the original (unmodified) vaulted content. This line
+        #    of text has several important qualities: 1) it exists in the raw text of the file, 2)
+        #    it is pseudo-guaranteed to be unique, and 3) it is guaranteed to exist (vaulted content
+        #    will be at least one line long, but possibly no more)
+        search_data = old_data.split(b"\n")[1]
+        # 2. Next we find the full line of text from the file that includes the above string.
+        #    This is important because the full line of text will include the leading
+        #    whitespace, which the YAML parser helpfully strips out from the parsed data.
+        # 3. Next we grab the number of leading whitespace characters on that line
+        padding = _get_line_padding(content, search_data)
+        if padding is None:
+            # This is to handle an edgecase where the vaulted content is actually a yaml anchor. For
+            # example, if a single vaulted secret needs to be stored under multiple variable names.
+            # In that case, the vaulted content iself will only appear once in the file, but the data
+            # parsed from the file will include it twice. If we fail to get a match on the first line, then
+            # we check whether the data is a yaml alias and, if it is, we skip it.
+            if is_alias:
                 logger.debug(
-                    f"User skipped vault encrypted content in {path} at {name} via interactive mode"
+                    f"Content replacement for encrypted content in {path} at {name} was not found, so replacement will be skipped because target is a YAML alias"
                 )
                 return content
-
-            try:
-                new_data = rekey(old, new, data.value.encode())
-            except AnsibleVaultError as err:
-                msg = f"Failed to decrypt vault encrypted data in {path} at {name} with provided vault secret"
-                if ignore:
-                    logger.warning(msg)
-                    return content
-                raise RuntimeError(msg) from err
-            content_decoded = content.decode("utf-8")
-
-            # Ok so this next section is probably the worst possible way to do this, but I did
-            # it this way to solve a very specific problem that would absolutely prevent people
-            # from using this tool: round trip YAML format preservation. Namely, that it's impossible.
-            # Ruamel gets the closest to achieving this: it can do round trip format preservation
-            # when the starting state is in _some_ known state (this is better than competitors which
-            # require the starting state to be in a _specific_ known state). But given how many
-            # ways there are to write YAML- and by extension, how many opinions there are on the
-            # "correct" way to write YAML- it is not possible to configure ruamel to account for all of
-            # them, even if everyones YAML style was compatible with ruamel's roundtrip formatting (note:
-            # they aren't). So there's the problem: to be useful, this tool would need to reformat every
-            # YAML file it touched, which means nobody would use it.
-            #
-            # To avoid the YAML formatting problem, we need a way to replace the target content
-            # in the raw text of the file without dumping the parsed YAML. We want to preserve
-            # indendation, remove any extra newlines that would be left over, add any necessary
-            # newlines without clobbering the following lines, and ideally avoid reimplementing
-            # a YAML formatter. The answer to this problem- as the answer to so many stupid problems
-            # seems to be- is a regex. If this is too janky for you (I know it is for me) go support
-            # the estraven project I'm trying to get off the ground: https://github.com/enpaul/estraven
-            #
-            # Ok, thanks for sticking with me as I was poetic about this. The solution below...
-            # is awful, I can admit that. But it does work, so I'll leave it up to
-            # your judgement as to whether it's worthwhile or not. Here's how it works:
-            #
-            # 1. First we take the first line of the original (unmodified) vaulted content. This line
-            #    of text has several important qualities: 1) it exists in the raw text of the file, 2)
-            #    it is pseudo-guaranteed to be unique, and 3) it is guaranteed to exist (vaulted content
-            #    will be at least one line long, but possibly no more)
-            search_data = data.value.split("\n")[1]
-            try:
-                # 2. Next we use a regex to grab the full line of text from the file that includes the above
-                #    string. This is important because the full line of text will include the leading
-                #    whitespace, which ruamel helpfully strips out from the parsed data.
-                # 3. Next we grab the number of leading spaces on the line using the capture group from the
-                #    regex
-                padding = len(
-                    re.search(rf"\n(\s*){search_data}\n", content_decoded).groups()[0]
-                )
-            except (TypeError, AttributeError):
-                # This is to handle an edgecase where the vaulted content is actually a yaml anchor. For
-                # example, if a single vaulted secret needs to be stored under multiple variable names.
-                # In that case, the vaulted content iself will only appear once in the file, but the data
-                # parsed by ruamel will include it twice. If we fail to get a match on the first line, then
-                # we check whether the data is a yaml anchor and, if it is, we skip it.
-                if data.anchor.value:
-                    logger.debug(
-                        f"Content replacement for encrypted content in {path} at {name} was not found, so replacement will be skipped because target is a YAML anchor"
-                    )
-                    return content
-                raise
-
-            # 4. Now with the leading whitespace padding, we add this same number of spaces to each line
-            #    of *both* the old vaulted data and the new vaulted data. It's important to do both because
-            #    we'll need to do a replacement in a moment so we need to know both what we're replacing
-            #    and what we're replacing it with.
-            padded_old_data = "\n".join(
-                [f"{' ' * padding}{item}" for item in data.value.split("\n") if item]
-            )
-            padded_new_data = "\n".join(
-                [
-                    f"{' ' * padding}{item}"
-                    for item in new_data.decode("utf-8").split("\n")
-                    if item
-                ]
+            raise RuntimeError(
+                f"Failed to locate vault encrypted data in {path} at {name} in the file content"
             )
 
-            # 5. Finally, we actually replace the content. This needs to have a count=1 so that if the same
-            #    encrypted block appears twice in the same file we only replace the first occurance of it,
-            #    otherwise the later replacement attempts will fail. We also need to re-encode it back to
-            #    bytes because all file operations with vault are done in bytes mode
-            content = content_decoded.replace(
-                padded_old_data, padded_new_data, 1
-            ).encode()
+        # 4. Now with the leading whitespace padding, we add this same number of spaces to each line
+        #    of *both* the old vaulted data and the new vaulted data. It's important to do both because
+        #    we'll need to do a replacement in a moment so we need to know both what we're replacing
+        #    and what we're replacing it with.
+        padded_old_data = _indent(old_data, padding)
+        padded_new_data = _indent(new_data, padding)
+
+        # 5. Finally, we actually replace the content. This needs to have a count=1 so that if the same
+        #    encrypted block appears twice in the same file we only replace the first occurance of it,
+        #    otherwise the later replacement attempts will fail.
+        return content.replace(padded_old_data, padded_new_data, 1)
+
+    def _process_yaml_data(content: bytes, data: Any) -> bytes:
+        # The parsed data is walked using an explicit stack instead of recursion, which avoids
+        # the function call overhead per node and can't hit the recursion limit on deeply
+        # nested documents. Children are pushed in reverse so that they're popped (and
+        # therefore rekeyed) in the same order they appear in the document
+        stack = deque([(data, "")])
+        while stack:
+            node, name = stack.pop()
+            node_type = type(node)
+            if node_type is _VaultTag:
+                if node.value.startswith(_VAULT_HEADER_TEXT):
+                    content = _rekey_one(content, node, name)
+                continue
+            iter_children = _YAML_CHILDREN.get(node_type)
+            if iter_children:
+                stack.extend(
+                    reversed(
+                        [(value, f"{name}.{key}") for key, value in iter_children(node)]
+                    )
+                )
         return content
 
-    with path.open("rb") as infile:
-        raw = infile.read()
+    # The file stats need to be taken before the file is read, so that the result can't
+    # claim the file has no vaulted data if it was modified after it was read
+    scan_key = _get_scan_key(path)
+    raw = path.read_bytes()
 
-    # The 'is_encrypted' check doesn't rely on the vault secret in the VaultLib matching the
-    # secret the data was encrypted with, it just checks that the data is encrypted with some
-    # vault secret. We could use either `old` or `new` for this check, it doesn't actually matter.
-    if old.is_encrypted(raw):
+    # Checking for the vault header directly is equivalent to ``VaultLib.is_encrypted`` (which
+    # doesn't rely on the vault secret at all) but skips decoding the entire file content
+    # to check just the first few bytes of it
+    if raw.startswith(_VAULT_HEADER):
         logger.info(f"Identified vault encrypted file: {path}")
 
         confirm = (
@@ -221,7 +482,7 @@ def _process_file(  # pylint: disable=too-many-statements
             logger.debug(
                 f"User skipped vault encrypted file {path} via interactive mode"
             )
-            return
+            return None
 
         if backup:
             path.rename(f"{path}.bak")
@@ -232,37 +493,51 @@ def _process_file(  # pylint: disable=too-many-statements
             msg = f"Failed to decrypt vault encrypted file {path} with provided vault secret"
             if ignore:
                 logger.warning(msg)
-                return
+                return None
             raise RuntimeError(msg) from None
     elif path.suffix.lower() in YAML_FILE_EXTENSIONS:
         logger.debug(f"Identified YAML file: {path}")
 
+        # Parsing the YAML is by far the most expensive part of processing a file that
+        # doesn't contain any vaulted data, so if the vault tag doesn't appear anywhere in
+        # the raw content then there's no reason to bother parsing it at all
+        if b"!vault" not in raw:
+            logger.debug(f"Skipping YAML file {path} with no vault encrypted variables")
+            return scan_key
+
         confirm = (
             _confirm(f"Search YAML file {path} for vault encrypted variables?")
             if interactive
             else True
         )
 
-        data = yaml.load(raw)
-
         if not confirm:
             logger.debug(
                 f"User skipped processing YAML file {path} via interactive mode"
             )
-            return
+            return None
 
         if backup:
             shutil.copy(path, f"{path}.bak")
 
-        updated = _process_yaml_data(raw, data, ignore=ignore)
+        scanned = _process_vault_blocks(raw)
+        if scanned is None:
+            logger.debug(
+                f"Not all vault encrypted variables in {path} could be identified from the raw content, falling back to parsing the YAML"
+            )
+            data = yaml.load(raw, Loader=_VaultLoader)  # nosec
+            updated = _process_yaml_data(raw, data)
+        else:
+            updated = scanned
     else:
         logger.debug(f"Skipping non-vault file {path}")
-        return
+        return scan_key
 
     logger.debug(f"Writing updated file contents to {path}")
 
-    with path.open("wb") as outfile:
-        outfile.write(updated)
+    path.write_bytes(updated)
+
+    return None
 
 
 def _get_args() -> argparse.Namespace:
@@ -292,6 +567,13 @@ def _get_args() -> argparse.Namespace:
         help="Write a backup of every file to be modified, suffixed with '.bak'",
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of files to process in parallel; defaults to the number of CPUs available. Ignored in interactive mode",
+        type=int,
+        default=os.cpu_count() or 1,
+    )
     parser.add_argument(
         "-i",
         "--vault-id",
@@ -316,6 +598,19 @@ def _get_args() -> argparse.Namespace:
         type=str,
         dest="new_pass_file",
     )
+    parser.add_argument(
+        "--no-cache",
+        help="Don't skip files that were found to contain no vaulted data on a previous run, and don't record which files contain no vaulted data on this run",
+        action="store_false",
+        dest="cache",
+    )
+    parser.add_argument(
+        "-e",
+        "--exclude",
+        help=f"Glob pattern of file or directory names to skip when searching directories; can be repeated. Always includes {', '.join(DEFAULT_EXCLUDES)}",
+        action="append",
+        dest="excludes",
+    )
     parser.add_argument(
         "paths", help="Paths to search for Ansible Vault encrypted content", nargs="*"
     )
@@ -328,14 +623,57 @@ def _confirm(prompt: str, default: bool = True) -> bool:
         confirm = input(f"{prompt} [{'YES/no' if default else 'yes/NO'}]: ")
         if not confirm:
             return default
-        if confirm.lower() in ["yes", "y"]:
+        answer = confirm.lower()
+        if answer in _YES_ANSWERS:
             return True
-        if confirm.lower() in ["no", "n"]:
+        if answer in _NO_ANSWERS:
             return False
         print("Please input one of the specified options", file=sys.stderr)
 
 
-def _expand_paths(paths: Iterable[Path]) -> List[Path]:
+def _compile_excludes(patterns: Sequence[str]) -> Optional[Pattern[str]]:
+    """Combine glob patterns into a single regex
+
+    :param patterns: Glob patterns to combine
+    :returns: Compiled regex that matches any string matched by any of ``patterns``, or
+              ``None`` if no patterns were provided
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+
+
+def _is_candidate(path: Path) -> bool:
+    """Determine whether a file could contain any vaulted data
+
+    :param path: Path to the file to check
+    :returns: Whether the file is a regular file and is either a YAML file or a vault
+              encrypted file
+    """
+    # Opening something that isn't a regular file (a FIFO for example) to check for the
+    # vault header can block forever, so anything else is never a candidate
+    if not path.is_file():
+        return False
+    if path.suffix.lower() in YAML_FILE_EXTENSIONS:
+        return True
+    try:
+        with path.open("rb") as infile:
+            return infile.read(len(_VAULT_HEADER)) == _VAULT_HEADER
+    except OSError:
+        return False
+
+
+def _expand_paths(
+    paths: Iterable[Path], exclude: Optional[Pattern[str]] = None
+) -> List[Path]:
+    """Identify every file under a set of paths that could contain vaulted data
+
+    :param paths: Paths to search. Files are always included, directories are recursively
+                  searched for either YAML files or vault encrypted files
+    :param exclude: Optional regex matching the names of files and directories to skip
+                    when searching directories
+    :returns: List of files to process
+    """
     logger = logging.getLogger(__name__)
 
     results = []
@@ -346,10 +684,30 @@ def _expand_paths(paths: Iterable[Path]) -> List[Path]:
             results.append(path)
         elif path.is_dir():
             logger.debug(f"Identifying files under {path}")
-            results += _expand_paths(path.iterdir())
+            # Walking the tree in one go is much cheaper than recursing into each directory,
+            # both because it avoids the per-level overhead and because the directory scan
+            # already knows which entries are files without needing to stat each one
+            for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+                if exclude:
+                    # Modifying the directory names in-place prevents walking into them
+                    dirnames[:] = [item for item in dirnames if not exclude.match(item)]
+                    filenames = [item for item in filenames if not exclude.match(item)]
+                for item in filenames:
+                    # Resolve symlinks so that the target file is what gets backed up and
+                    # rewritten, rather than the link being replaced with a regular file
+                    filepath = Path(dirpath, item).resolve()
+                    # The directory listing includes anything that isn't a directory, so
+                    # things like broken symlinks and FIFOs are filtered out here too
+                    if _is_candidate(filepath):
+                        results.append(filepath)
+                    else:
+                        logger.debug(f"Discarding path {filepath}")
         else:
             logger.debug(f"Discarding path {path}")
-    return results
+
+    # Resolving symlinks can result in the same file being found more than once, and it
+    # must only be processed once or parallel jobs could end up rewriting it concurrently
+    return list(dict.fromkeys(results))
 
 
 def _load_password(
@@ -369,8 +727,7 @@ def _load_password(
 
     if fpath:
         try:
-            with Path(fpath).resolve().open("rb") as infile:
-                return VaultSecret(infile.read())
+            return VaultSecret(Path(fpath).resolve().read_bytes())
         except (FileNotFoundError, PermissionError) as err:
             raise RuntimeError(
                 f"Specified vault password file '{fpath}' does not exist or is unreadable"
@@ -394,18 +751,183 @@ def _load_password(
     return VaultSecret(password_1.encode("utf-8"))
 
 
-def main():
-    """Main program entrypoint and CLI interface"""
-    args = _get_args()
+def _get_cache_path() -> Path:
+    """Determine the path to the scan cache file
+
+    :returns: Path to the file storing the files known to not contain any vaulted data
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_dir, __title__, "scanned.json")
+
+
+def _load_scan_cache(cache_path: Path) -> Dict[str, List[int]]:
+    """Load the scan cache from disk
+
+    :param cache_path: Path to the scan cache file
+    :returns: Mapping of file paths known to not contain any vaulted data to the
+              modification time (in nanoseconds) and size of the file when it was scanned.
+              If the cache file doesn't exist or can't be read then the mapping is empty.
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        cache = json.loads(cache_path.read_bytes())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        logger.warning(f"Failed to load scan cache from {cache_path}: {err}")
+        return {}
+
+    if not isinstance(cache, dict):
+        logger.warning(f"Ignoring invalid scan cache {cache_path}")
+        return {}
+    return cache
 
+
+def _save_scan_cache(cache_path: Path, cache: Dict[str, List[int]]) -> None:
+    """Write the scan cache to disk
+
+    :param cache_path: Path to the scan cache file
+    :param cache: Mapping of file paths to file stats to store in the cache
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so that an interrupted write can't leave a
+        # truncated cache behind
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        tmp_path.write_text(json.dumps(cache), encoding="utf-8")
+        tmp_path.replace(cache_path)
+    except OSError as err:
+        logger.warning(f"Failed to write scan cache to {cache_path}: {err}")
+
+
+def _get_scan_key(path: Path) -> List[int]:
+    """Get the file stats used to identify whether a file has changed since it was scanned
+
+    :param path: Path to the file to stat
+    :returns: The modification time (in nanoseconds) and size of the file
+    """
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _filter_scanned(files: Iterable[Path], cache: Dict[str, List[int]]) -> List[Path]:
+    """Remove files that are known to not contain any vaulted data
+
+    Files that had no vaulted data the last time they were scanned and that haven't been
+    modified since can't have gained any vaulted data, so they don't need to be processed.
+
+    :param files: Files to filter
+    :param cache: Scan cache loaded using :func:`_load_scan_cache`
+    :returns: List of files from ``files`` that need to be processed
+    """
     logger = logging.getLogger(__name__)
 
+    results = []
+    for path in files:
+        try:
+            scan_key = _get_scan_key(path)
+        except FileNotFoundError:
+            logger.debug(f"Discarding path {path} which no longer exists")
+            cache.pop(str(path), None)
+            continue
+        if cache.get(str(path)) == scan_key:
+            logger.debug(f"Skipping unchanged file {path} with no vaulted data")
+        else:
+            results.append(path)
+    return results
+
+
+def _update_scan_cache(
+    cache: Dict[str, List[int]],
+    files: Iterable[Path],
+    scan_keys: Iterable[Optional[List[int]]],
+) -> None:
+    """Record which processed files do not contain any vaulted data
+
+    :param cache: Scan cache to update in-place
+    :param files: Files that were processed
+    :param scan_keys: Result of :func:`_process_file` for each file in ``files``
+    """
+    for path, scan_key in zip(files, scan_keys):
+        if scan_key is None:
+            cache.pop(str(path), None)
+        else:
+            cache[str(path)] = scan_key
+
+    # Prune any files that have been deleted since they were recorded so that the cache
+    # doesn't grow forever
+    for item in [item for item in cache if not os.path.isfile(item)]:
+        del cache[item]
+
+
+def _cache_key_derivation() -> None:
+    """Cache the vault key derivation function to avoid repeated PBKDF2 rounds
+
+    Every decrypt/encrypt operation derives its keys from the vault password using 10,000
+    rounds of PBKDF2, which makes it by far the most expensive part of a vault operation.
+    The derived key depends only on the password and the salt, so the result can be safely
+    reused whenever the same encrypted content shows up more than once. Newer versions of
+    Ansible cache this internally but older versions do not.
+    """
+    # pylint: disable=protected-access
+    if hasattr(VaultAES256._create_key_cryptography, "cache_info"):
+        return
+    VaultAES256._create_key_cryptography = staticmethod(  # type: ignore
+        functools.lru_cache(maxsize=4096)(VaultAES256._create_key_cryptography)
+    )
+
+
+def _init_worker(verbose: int, old: VaultLib, new: VaultLib) -> None:
+    """Setup the runtime state of a worker process
+
+    :param verbose: Logging verbosity to pass through to :func:`_setup_logging`
+    :param old: VaultLib object with the current (old) vault password encoded in it
+    :param new: VaultLib object with the target (new) vault password encoded in it
+    """
+    _setup_logging(verbose)
+    _cache_key_derivation()
+    # The vault objects are only sent to each worker once and then reused for every file
+    # the worker processes, since :func:`rekey` caches on the identity of the objects
+    _WORKER_VAULTS["old"] = old
+    _WORKER_VAULTS["new"] = new
+
+
+def _process_file_worker(path: Path, **kwargs: Any) -> Optional[List[int]]:
+    """Process a file in a worker process using the vault objects setup for the worker
+
+    :param path: Path to the file to process
+    :param kwargs: Additional arguments to pass through to :func:`_process_file`
+    :returns: The result of :func:`_process_file`
+    """
+    return _process_file(
+        path, old=_WORKER_VAULTS["old"], new=_WORKER_VAULTS["new"], **kwargs
+    )
+
+
+def _setup_logging(verbose: int) -> None:
+    """Configure the root logger
+
+    :param verbose: Number of levels to increase the logging verbosity by from the default
+                    of ``WARNING``
+    """
     logging.basicConfig(
         stream=sys.stderr,
         format="%(levelname)s: %(message)s",
-        level=max(logging.WARNING - (args.verbose * 10), 0),
+        level=max(logging.WARNING - (verbose * 10), 0),
     )
 
+
+def main() -> None:
+    """Main program entrypoint and CLI interface"""
+    args = _get_args()
+
+    logger = logging.getLogger(__name__)
+
+    _setup_logging(args.verbose)
+
     if args.version:
         print(f"{__title__} {__version__}")
         sys.exit(0)
@@ -414,6 +936,19 @@ def main():
         logger.warning("No paths provided, nothing to do!")
         sys.exit(0)
 
+    if _HAS_CRYPTOGRAPHY:
+        logger.debug("Using cryptography backend for vault operations")
+    else:
+        logger.warning(
+            "The 'cryptography' package could not be imported; vault operations will be significantly slower or may fail entirely depending on the installed version of Ansible"
+        )
+
+    _cache_key_derivation()
+
+    if args.jobs < 1:
+        logger.error(f"Number of jobs must be at least 1, got {args.jobs}")
+        sys.exit(1)
+
     try:
         old_pass = _load_password(args.old_pass_file, desc="existing", confirm=False)
         new_pass = _load_password(args.new_pass_file, desc="new", confirm=True)
@@ -429,18 +964,57 @@ def main():
     logger.info(
         f"Identifying all files under {len(args.paths)} input paths: {', '.join(args.paths)}"
     )
-    files = _expand_paths(args.paths)
+    files = _expand_paths(
+        args.paths,
+        exclude=_compile_excludes([*DEFAULT_EXCLUDES, *(args.excludes or [])]),
+    )
     logger.info(f"Identified {len(files)} files for processing")
 
-    for filepath in files:
-        _process_file(
-            filepath,
-            in_vault,
-            out_vault,
-            args.interactive,
-            args.backup,
-            args.ignore_undecryptable,
+    cache_path = _get_cache_path()
+    cache = _load_scan_cache(cache_path) if args.cache else {}
+    if cache:
+        unscanned = _filter_scanned(files, cache)
+        logger.info(
+            f"Skipping {len(files) - len(unscanned)} unchanged files with no vaulted data"
         )
+        files = unscanned
+
+    options = {
+        "interactive": args.interactive,
+        "backup": args.backup,
+        "ignore": args.ignore_undecryptable,
+    }
+
+    # Interactive mode needs to prompt for input for each file, which can't be done from
+    # multiple processes at once, so it always processes files one at a time. Starting
+    # worker processes isn't worth it for a single file either. When files are processed
+    # one at a time the jobs are used to rekey the variables within each file
+    # concurrently instead
+    if args.interactive or args.jobs == 1 or len(files) <= 1:
+        results = [
+            _process_file(filepath, in_vault, out_vault, threads=args.jobs, **options)
+            for filepath in files
+        ]
+    else:
+        # There's no point starting more worker processes than there are files to process
+        args.jobs = min(args.jobs, len(files))
+        logger.debug(f"Processing files using {args.jobs} parallel jobs")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=_init_worker,
+            initargs=(args.verbose, in_vault, out_vault),
+        ) as executor:
+            results = list(
+                executor.map(
+                    functools.partial(_process_file_worker, **options),
+                    files,
+                    chunksize=8,
+                )
+            )
+
+    if args.cache:
+        _update_scan_cache(cache, files, results)
+        _save_scan_cache(cache_path, cache)
 
 
 if __name__ == "__main__":